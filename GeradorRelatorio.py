@@ -1,12 +1,16 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import xlsxwriter
+import hashlib
 from io import BytesIO
 
 # --- CONFIGURAÇÃO DA PÁGINA ---
 st.set_page_config(page_title="Gestão de Produção & Qualidade", layout="wide")
 TEMPLATE_GRAFICO = "plotly_white"
+EXIBICAO_COLS = ['Linha', 'Equipe', 'M2_Produzido', 'Meta_M2', 'M2_Retido', 'Saldo_M2', '% Realizado']
 
 # --- CSS PARA IMPRESSÃO ---
 st.markdown("""
@@ -25,37 +29,72 @@ st.markdown("""
 st.title("🏭 Dashboard de Controle de Retidos")
 
 # --- FUNÇÕES AUXILIARES ---
-def mapear_linha(forno):
-    try:
-        # Tenta pegar apenas numeros caso venha texto misturado (ex: "Forno 10")
-        import re
-        nums = re.findall(r'\d+', str(forno))
-        if nums:
-            forno_int = int(nums[0])
-        else:
-            return 'Outros'
-            
-        if forno_int in [10, 11]: return 'Linha 4 e 5'
-        elif forno_int in [12, 13]: return 'Linha 6'
-        else: return 'Outros'
-    except: return 'Outros'
-
-def limpar_numero(val):
-    if pd.isna(val): return 0.0
-    if isinstance(val, (int, float)): return float(val)
-    # Remove R$, espaços e converte formato BR para US
-    val = str(val).strip().replace('R$', '').replace(' ', '')
-    val = val.replace('.', '').replace(',', '.')
-    try: return float(val)
-    except: return 0.0
+MAPA_FORNOS = {10: 'Linha 4 e 5', 11: 'Linha 4 e 5', 12: 'Linha 6', 13: 'Linha 6'}
+TIPO_LINHA = pd.CategoricalDtype(['Linha 4 e 5', 'Linha 6', 'Outros'])
+
+def mapear_linha_series(s):
+    # A regex roda só nos valores distintos (poucos fornos); o resultado é espalhado pelos códigos
+    codigos, unicos = pd.factorize(s)
+    # Pega apenas o primeiro número caso venha texto misturado (ex: "Forno 10")
+    nums = pd.Series(unicos).astype(str).str.extract(r'(\d+)', expand=False)
+    linhas = pd.to_numeric(nums, errors='coerce').map(MAPA_FORNOS).fillna('Outros')
+    cod_linha = TIPO_LINHA.categories.get_indexer(linhas)
+    # Código -1 (valor vazio) pega o último item do array: 'Outros'
+    cod_linha = np.append(cod_linha, TIPO_LINHA.categories.get_loc('Outros'))
+    return pd.Series(pd.Categorical.from_codes(cod_linha[codigos], dtype=TIPO_LINHA), index=s.index)
+
+def converter_texto_br(s):
+    # Remove R$, espaços (inclusive o NBSP que o Excel usa em moeda) e converte formato BR para US
+    return pd.to_numeric(s.str.replace(r'R\$|[\s\xa0]', '', regex=True)
+                          .str.replace('.', '', regex=False)
+                          .str.replace(',', '.', regex=False), errors='coerce')
+
+def limpar_series(s):
+    if pd.api.types.is_numeric_dtype(s): return s.fillna(0.0).astype('float64')
+    if not pd.api.types.is_object_dtype(s): return converter_texto_br(s).fillna(0.0).astype('float64')
+    # Colunas mistas do Excel (object): números já vêm prontos, só as células de texto são convertidas
+    eh_texto = s.map(type).eq(str)
+    if eh_texto.all(): return converter_texto_br(s).fillna(0.0).astype('float64')
+    convertido = pd.Series(np.nan, index=s.index)
+    convertido[eh_texto] = converter_texto_br(s[eh_texto])
+    convertido[~eh_texto] = pd.to_numeric(s[~eh_texto], errors='coerce')
+    return convertido.fillna(0.0)
+
+def valor_excel(v):
+    # Mesmo tratamento do to_excel: NaN em branco e inf como texto (inf_rep padrão 'inf')
+    if pd.isna(v): return None
+    if isinstance(v, float) and np.isinf(v): return 'inf' if v > 0 else '-inf'
+    return v
 
 @st.cache_data
 def convert_df_to_excel(df):
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Dados')
+    # Não usa df.to_excel: ele grava coluna por coluna e, com constant_memory (que só mantém a
+    # linha atual), perde todas as colunas depois da primeira. Por isso as linhas vão direto no
+    # worksheet, em ordem. Obs.: o cabeçalho sai sem o negrito/borda que o pandas aplicava.
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    ws = workbook.add_worksheet('Dados')
+    ws.write_row(0, 0, [str(c) for c in df.columns])
+    for i, linha in enumerate(df.itertuples(index=False, name=None), start=1):
+        ws.write_row(i, 0, [valor_excel(v) for v in linha])
+    workbook.close()
     return output.getvalue()
 
+MES_SEM_DATA = 999999  # Chave de mes_ano sem coluna de data; maior que qualquer AAAAMM, ordena por último
+
+def chave_mes(datas):
+    # Mês como inteiro AAAAMM: agrupa/ordena sem criar uma string por linha
+    return (datas.dt.year * 100 + datas.dt.month).astype('Int32')
+
+def rotulo_mes(chaves):
+    # Só formata no resultado agregado (pequeno): 202401 -> '2024-01'
+    texto = (chaves // 100).astype(str) + '-' + (chaves % 100).astype(str).str.zfill(2)
+    return texto.where(chaves.ne(MES_SEM_DATA), 'Sem Data')
+
+def formatar_valores(s, fmt=',.2f', sufixo=''):
+    # tolist() converte o array inteiro em floats Python de uma vez (sem boxing por item da Series)
+    return [format(v, fmt) + sufixo for v in s.to_numpy().tolist()]
+
 def identificar_coluna(df, keywords, nome_padrao_exibicao):
     """
     Procura nas colunas do DF se existe alguma que contenha as keywords.
@@ -71,99 +110,209 @@ def identificar_coluna(df, keywords, nome_padrao_exibicao):
                 return mapa_cols[col]
     return None
 
-def carregar_arquivo(uploaded_file):
+def ler_csv(bio, **kwargs):
+    # Engine pyarrow (multithread) quando disponível; se não estiver instalado ou não conseguir ler, usa o engine C padrão
+    try:
+        return pd.read_csv(bio, engine='pyarrow', **kwargs)
+    except Exception:
+        bio.seek(0)
+        return pd.read_csv(bio, **kwargs)
+
+def ler_excel(bio):
+    # Engine calamine (Rust) quando disponível (pandas >= 2.2 + python-calamine); senão, o padrão (openpyxl)
+    try:
+        return pd.read_excel(bio, engine='calamine')
+    except Exception:
+        bio.seek(0)
+        return pd.read_excel(bio)
+
+@st.cache_data
+def carregar_arquivo(data, nome):
+    # Cache pelo conteúdo do arquivo: reruns (slider, checkbox...) não relêem o Excel/CSV
+    bio = BytesIO(data)
     try:
-        if uploaded_file.name.lower().endswith('.csv'):
+        if nome.lower().endswith('.csv'):
             # Tenta ler CSV com diferentes separadores
             try:
-                return pd.read_csv(uploaded_file)
+                return ler_csv(bio)
             except:
-                uploaded_file.seek(0)
-                return pd.read_csv(uploaded_file, sep=';')
+                bio.seek(0)
+                return ler_csv(bio, sep=';')
         else:
-            return pd.read_excel(uploaded_file)
+            return ler_excel(bio)
     except Exception as e:
         return None
 
+@st.cache_data
+def preparar_producao(data, nome):
+    """
+    Carrega o arquivo de Produção, identifica as colunas e faz o tratamento.
+    Renomeia as colunas identificadas para nomes fixos ('Equipe', 'Linha_raw').
+    Retorna (df, lista de erros); df é None se a leitura falhar.
+    """
+    df = carregar_arquivo(data, nome)
+    if df is None: return None, []
+
+    cols = {
+        'equipe': identificar_coluna(df, ['equipe', 'team', 'turno'], 'Equipe'),
+        'forno': identificar_coluna(df, ['forno', 'linha', 'maq'], 'Forno/Linha'),
+        'metragem': identificar_coluna(df, ['metragem', 'm2', 'prod'], 'Metragem/Produção'),
+        'data': identificar_coluna(df, ['data', 'date', 'dia'], 'Data'), # Opcional
+    }
+    erros = []
+    if not cols['equipe']: erros.append("Arquivo Produção: Coluna de 'Equipe' não encontrada.")
+    if not cols['forno']: erros.append("Arquivo Produção: Coluna de 'Forno' ou 'Linha' não encontrada.")
+    if not cols['metragem']: erros.append("Arquivo Produção: Coluna de 'Metragem' ou 'Produção' não encontrada.")
+    if erros: return df, erros
+
+    df['metragem_real'] = limpar_series(df[cols['metragem']])
+    if cols['data']:
+        df['data_obj'] = pd.to_datetime(df[cols['data']], dayfirst=True, errors='coerce')
+        df['mes_ano'] = chave_mes(df['data_obj'])
+    else: df['mes_ano'] = MES_SEM_DATA
+    df = df.rename(columns={cols['equipe']: 'Equipe', cols['forno']: 'Linha_raw'})
+    df['Equipe'] = df['Equipe'].astype('category')
+    df['Linha'] = mapear_linha_series(df['Linha_raw'])
+    return df, erros
+
+@st.cache_data
+def preparar_retidos(data, nome):
+    """
+    Carrega o arquivo de Retidos, identifica as colunas e faz o tratamento.
+    Renomeia as colunas identificadas para nomes fixos ('Equipe', 'Linha_raw', 'Motivo').
+    Retorna (df, lista de erros); df é None se a leitura falhar.
+    """
+    df = carregar_arquivo(data, nome)
+    if df is None: return None, []
+
+    cols = {
+        'motivo': identificar_coluna(df, ['motivo', 'defeito', 'causa'], 'Motivo'),
+        'm2': identificar_coluna(df, ['m²', 'm2', 'metragem', 'quant'], 'M2 Retido'),
+        'equipe': identificar_coluna(df, ['equipe', 'team', 'turno'], 'Equipe'),
+        'forno': identificar_coluna(df, ['forno', 'linha', 'maq'], 'Forno/Linha'),
+        'data': identificar_coluna(df, ['data', 'date', 'dia', 'hora'], 'Data'), # Opcional
+    }
+    erros = []
+    if not cols['motivo']: erros.append("Arquivo Retidos: Coluna de 'Motivo' não encontrada.")
+    if not cols['m2']: erros.append("Arquivo Retidos: Coluna de 'M2' ou 'Metragem' não encontrada.")
+    if not cols['equipe']: erros.append("Arquivo Retidos: Coluna de 'Equipe' não encontrada.")
+    if not cols['forno']: erros.append("Arquivo Retidos: Coluna de 'Forno' ou 'Linha' não encontrada.")
+    if erros: return df, erros
+
+    df['m2_real'] = limpar_series(df[cols['m2']])
+    if cols['data']:
+        df['data_obj'] = pd.to_datetime(df[cols['data']], dayfirst=True, errors='coerce')
+        df['mes_ano'] = chave_mes(df['data_obj'])
+    else: df['mes_ano'] = MES_SEM_DATA
+    df = df.rename(columns={cols['equipe']: 'Equipe', cols['forno']: 'Linha_raw', cols['motivo']: 'Motivo'})
+    df['Equipe'] = df['Equipe'].astype('category')
+    df['Motivo'] = df['Motivo'].astype('category')
+    df['Linha'] = mapear_linha_series(df['Linha_raw'])
+    return df, erros
+
 # --- FUNÇÕES DE CÁLCULO E GRÁFICO ---
+def hash_df(df):
+    # Hash de todo o conteúdo (o hash padrão do Streamlit usa só uma amostra em frames grandes)
+    h = hashlib.md5(pd.util.hash_pandas_object(df, index=True).values)
+    h.update(str(list(df.columns)).encode())
+    return h.digest()
+
+# Figuras reaproveitadas entre reruns enquanto os dados e a meta não mudam
+# (max_entries limita o acúmulo de combinações de meta/filtros já vistas)
+cache_figura = st.cache_data(hash_funcs={pd.DataFrame: hash_df}, max_entries=32)
+
+def calcular_kpis(prod, ret, meta_pct, inf_sem_producao=True):
+    # Opera direto nos arrays. Sem produção: 0% se também não houve retido; com retido, inf (fora da
+    # meta) por equipe, ou 0 se inf_sem_producao=False (regra da 'Média Geral')
+    meta = prod * (meta_pct / 100)
+    sem_producao = np.where((ret > 0) & inf_sem_producao, np.inf, 0.0)
+    pct = np.divide(ret, prod, out=sem_producao, where=prod > 0) * 100
+    return {'Meta_M2': meta, 'Saldo_M2': meta - ret, '% Realizado': pct}
+
 def adicionar_linha_geral(df_original, nome_linha, meta_pct):
-    df_filt = df_original[df_original['Linha'] == nome_linha].copy()
-    if df_filt.empty: return df_filt
-
-    total_prod = df_filt['M2_Produzido'].sum()
-    total_ret = df_filt['M2_Retido'].sum()
-    meta_m2_total = total_prod * (meta_pct / 100)
-    saldo_total = meta_m2_total - total_ret
-    pct_geral = (total_ret / total_prod * 100) if total_prod > 0 else 0
-    
+    sub = df_original.loc[df_original['Linha'] == nome_linha]
+    if sub.empty: return sub.copy()
+
+    total_prod, total_ret = sub[['M2_Produzido', 'M2_Retido']].to_numpy().sum(axis=0)
     row_geral = pd.DataFrame({
         'Linha': [nome_linha], 'Equipe': ['Média Geral'], 
         'M2_Produzido': [total_prod], 'M2_Retido': [total_ret],
-        'Meta_M2': [meta_m2_total], 'Saldo_M2': [saldo_total], '% Realizado': [pct_geral]
+        **calcular_kpis(np.array([total_prod]), np.array([total_ret]), meta_pct, inf_sem_producao=False)
     })
     
-    df_filt['Equipe'] = df_filt['Equipe'].astype(str)
-    df_final = pd.concat([df_filt, row_geral], ignore_index=True)
-    df_final['Ordem'] = df_final['Equipe'].apply(lambda x: 1 if x == 'Média Geral' else 0)
-    df_final = df_final.sort_values(by=['Ordem', 'Equipe'])
-    return df_final
+    # Equipes como texto (códigos numéricos de turno viram '1', '2'...) renomeando só as categorias;
+    # ordem das categorias, e a 'Média Geral' entra por último já na concatenação
+    sub = sub.assign(Equipe=sub['Equipe'].cat.rename_categories(str))
+    return pd.concat([sub.sort_values('Equipe', kind='mergesort'), row_geral], ignore_index=True)
 
+@cache_figura
 def criar_tabela_grafica(df, meta_pct):
     if df.empty: return None
-    cor_texto_pct = ['#E74C3C' if v > meta_pct else '#27AE60' for v in df['% Realizado']]
-    cor_texto_saldo = ['#E74C3C' if v < 0 else '#27AE60' for v in df['Saldo_M2']]
+    cor_texto_pct = np.where(df['% Realizado'].to_numpy() > meta_pct, '#E74C3C', '#27AE60')
+    cor_texto_saldo = np.where(df['Saldo_M2'].to_numpy() < 0, '#E74C3C', '#27AE60')
     
     fig = go.Figure(data=[go.Table(
         header=dict(values=['<b>Linha</b>', '<b>Equipe</b>', '<b>Produção</b>', '<b>Meta (m²)</b>', '<b>Retido (m²)</b>', '<b>Saldo</b>', '<b>% Perda</b>'],
                     fill_color='#2E86C1', align='center', font=dict(color='white', size=12)),
         cells=dict(values=[df['Linha'], df['Equipe'], 
-                           [f"{v:,.2f}" for v in df['M2_Produzido']], 
-                           [f"{v:,.2f}" for v in df['Meta_M2']], 
-                           [f"{v:,.2f}" for v in df['M2_Retido']], 
-                           [f"{v:,.2f}" for v in df['Saldo_M2']], 
-                           [f"{v:.2f}%" for v in df['% Realizado']]],
+                           formatar_valores(df['M2_Produzido']), 
+                           formatar_valores(df['Meta_M2']), 
+                           formatar_valores(df['M2_Retido']), 
+                           formatar_valores(df['Saldo_M2']), 
+                           formatar_valores(df['% Realizado'], '.2f', '%')],
                    fill_color='#F7F9F9', align='center',
                    font=dict(color=['black', 'black', 'black', 'black', 'black', cor_texto_saldo, cor_texto_pct], size=11),
                    height=30))])
     fig.update_layout(margin=dict(l=0, r=0, t=0, b=0), height=400)
     return fig
 
+@cache_figura
 def criar_grafico_evolucao_com_geral(df_prod, df_ret, nome_linha, meta_pct):
-    df_p = df_prod[df_prod['Linha'] == nome_linha].copy()
-    df_r = df_ret[df_ret['Linha'] == nome_linha].copy()
+    df_p = df_prod.loc[df_prod['Linha'] == nome_linha, ['mes_ano', 'Equipe', 'metragem_real']]
+    df_r = df_ret.loc[df_ret['Linha'] == nome_linha, ['mes_ano', 'Equipe', 'm2_real']]
     if df_p.empty and df_r.empty: return None
     
-    p_eq = df_p.groupby(['mes_ano', 'Equipe'])['metragem_real'].sum().reset_index().rename(columns={'metragem_real': 'M2_Produzido'})
-    r_eq = df_r.groupby(['mes_ano', 'Equipe'])['m2_real'].sum().reset_index().rename(columns={'m2_real': 'M2_Retido'})
-    
-    if not df_p.empty:
-        p_tot = df_p.groupby(['mes_ano'])['metragem_real'].sum().reset_index().rename(columns={'metragem_real': 'M2_Produzido'})
-        p_tot['Equipe'] = 'Média Geral'
-    else: p_tot = pd.DataFrame()
-
-    if not df_r.empty:
-        r_tot = df_r.groupby(['mes_ano'])['m2_real'].sum().reset_index().rename(columns={'m2_real': 'M2_Retido'})
-        r_tot['Equipe'] = 'Média Geral'
-    else: r_tot = pd.DataFrame()
-
-    df_final = pd.merge(pd.concat([p_eq, p_tot]), pd.concat([r_eq, r_tot]), on=['mes_ano', 'Equipe'], how='outer').fillna(0)
-    df_final['Meta_M2'] = df_final['M2_Produzido'] * (meta_pct / 100)
-    df_final['Cor_Barra'] = df_final.apply(lambda row: '#27AE60' if row['M2_Retido'] <= row['Meta_M2'] else '#E74C3C', axis=1)
-    df_final['Ordem_Equipe'] = df_final['Equipe'].apply(lambda x: 1 if x == 'Média Geral' else 0)
-    df_final = df_final.sort_values(by=['mes_ano', 'Ordem_Equipe', 'Equipe'])
-    df_final['Label_X'] = df_final['mes_ano'].astype(str) + " | " + df_final['Equipe'].astype(str)
+    # Formato longo: as duas métricas no mesmo frame, agregadas num único groupby
+    longo = pd.concat([df_p.rename(columns={'metragem_real': 'val'}).assign(metrica='M2_Produzido'),
+                       df_r.rename(columns={'m2_real': 'val'}).assign(metrica='M2_Retido')], ignore_index=True)
+    def somar_por(chaves):
+        return (longo.groupby(chaves + ['metrica'], observed=True, sort=False)['val'].sum()
+                     .unstack('metrica', fill_value=0.0)
+                     .reindex(columns=['M2_Produzido', 'M2_Retido'], fill_value=0.0)
+                     .rename_axis(columns=None).reset_index())
+    df_eq = somar_por(['mes_ano', 'Equipe'])
+    # Total da linha a partir de todas as linhas do mês (inclui registros sem equipe, como antes)
+    df_tot = somar_por(['mes_ano']).assign(Equipe='Média Geral')
+
+    df_final = pd.concat([df_eq, df_tot], ignore_index=True)
+    # Colunas derivadas inseridas de uma vez só (evita fragmentar o frame com inserções sucessivas)
+    meta = df_final['M2_Produzido'].to_numpy() * (meta_pct / 100)
+    df_final = df_final.assign(
+        Meta_M2=meta,
+        Cor_Barra=np.where(df_final['M2_Retido'].to_numpy() <= meta, '#27AE60', '#E74C3C'),
+        Ordem_Equipe=np.where(df_final['Equipe'].eq('Média Geral'), 1, 0),
+        Label_X=rotulo_mes(df_final['mes_ano']) + " | " + df_final['Equipe'].astype(str),
+    ).sort_values(by=['mes_ano', 'Ordem_Equipe', 'Equipe'])
     
     fig = go.Figure()
     fig.add_trace(go.Bar(x=df_final['Label_X'], y=df_final['M2_Retido'], marker_color=df_final['Cor_Barra'],
-                         text=[f"{v:,.2f}" for v in df_final['M2_Retido']], textposition='inside', name='Realizado'))
-    fig.add_trace(go.Scatter(x=df_final['Label_X'], y=df_final['Meta_M2'], mode='markers',
-                             marker=dict(symbol='line-ew', color='black', size=30, line=dict(width=2)), name='Meta'))
-    fig.add_trace(go.Scatter(x=df_final['Label_X'], y=df_final['Meta_M2'], mode='text',
-                             text=[f"{v:,.2f}" for v in df_final['Meta_M2']], textposition="top center", 
-                             textfont=dict(size=9, color='black'), showlegend=False))
+                         text=formatar_valores(df_final['M2_Retido']), textposition='inside', name='Realizado'))
+    fig.add_trace(go.Scattergl(x=df_final['Label_X'], y=df_final['Meta_M2'], mode='markers',
+                               marker=dict(symbol='line-ew', color='black', size=30, line=dict(width=2)), name='Meta'))
+    fig.add_trace(go.Scattergl(x=df_final['Label_X'], y=df_final['Meta_M2'], mode='text',
+                               text=formatar_valores(df_final['Meta_M2']), textposition="top center", 
+                               textfont=dict(size=9, color='black'), showlegend=False))
     
     max_val = max(df_final['M2_Retido'].max(), df_final['Meta_M2'].max()) if not df_final.empty else 100
-    fig.update_layout(title=f"Evolução - {nome_linha}", yaxis=dict(range=[0, max_val * 1.25]), template=TEMPLATE_GRAFICO, showlegend=True)
+    # uirevision mantém zoom/pan entre reruns do Streamlit
+    fig.update_layout(title=f"Evolução - {nome_linha}", yaxis=dict(range=[0, max_val * 1.25]), template=TEMPLATE_GRAFICO, showlegend=True,
+                      uirevision=nome_linha)
+    return fig
+
+@cache_figura
+def criar_grafico_top(top, nome_linha):
+    fig = px.bar(top, y='Motivo_Analise', x='m2_real', orientation='h', title=f"Top 10 - {nome_linha}", text_auto='.2f', template=TEMPLATE_GRAFICO)
+    fig.update_layout(xaxis=dict(range=[0, top['m2_real'].max()*1.25]))
     return fig
 
 # --- BARRA LATERAL ---
@@ -180,9 +329,9 @@ with st.sidebar:
 
 # --- LÓGICA PRINCIPAL COM TRATATIVA DE ERRO ---
 if file_prod and file_ret:
-    # 1. Carregamento dos Arquivos
-    df_prod = carregar_arquivo(file_prod)
-    df_ret = carregar_arquivo(file_ret)
+    # 1. Carregamento, Identificação de Colunas e Tratamento (cacheados pelo conteúdo dos arquivos)
+    df_prod, erros_p = preparar_producao(file_prod.getvalue(), file_prod.name)
+    df_ret, erros_r = preparar_retidos(file_ret.getvalue(), file_ret.name)
 
     if df_prod is None:
         st.error(f"Erro ao ler o arquivo de Produção. Verifique se o formato está correto (.xlsx ou .csv).")
@@ -191,32 +340,8 @@ if file_prod and file_ret:
         st.error(f"Erro ao ler o arquivo de Retidos. Verifique se o formato está correto (.xlsx ou .csv).")
         st.stop()
 
-    # 2. Identificação de Colunas (Mapeamento Inteligente)
-    erros_mapeamento = []
-    
-    # --- Colunas Produção ---
-    col_equipe_p = identificar_coluna(df_prod, ['equipe', 'team', 'turno'], 'Equipe')
-    col_forno_p = identificar_coluna(df_prod, ['forno', 'linha', 'maq'], 'Forno/Linha')
-    col_metragem = identificar_coluna(df_prod, ['metragem', 'm2', 'prod'], 'Metragem/Produção')
-    col_data_p = identificar_coluna(df_prod, ['data', 'date', 'dia'], 'Data') # Opcional
-
-    if not col_equipe_p: erros_mapeamento.append("Arquivo Produção: Coluna de 'Equipe' não encontrada.")
-    if not col_forno_p: erros_mapeamento.append("Arquivo Produção: Coluna de 'Forno' ou 'Linha' não encontrada.")
-    if not col_metragem: erros_mapeamento.append("Arquivo Produção: Coluna de 'Metragem' ou 'Produção' não encontrada.")
-
-    # --- Colunas Retidos ---
-    col_motivo = identificar_coluna(df_ret, ['motivo', 'defeito', 'causa'], 'Motivo')
-    col_m2 = identificar_coluna(df_ret, ['m²', 'm2', 'metragem', 'quant'], 'M2 Retido')
-    col_equipe_r = identificar_coluna(df_ret, ['equipe', 'team', 'turno'], 'Equipe')
-    col_forno_r = identificar_coluna(df_ret, ['forno', 'linha', 'maq'], 'Forno/Linha')
-    col_data_r = identificar_coluna(df_ret, ['data', 'date', 'dia', 'hora'], 'Data') # Opcional
-
-    if not col_motivo: erros_mapeamento.append("Arquivo Retidos: Coluna de 'Motivo' não encontrada.")
-    if not col_m2: erros_mapeamento.append("Arquivo Retidos: Coluna de 'M2' ou 'Metragem' não encontrada.")
-    if not col_equipe_r: erros_mapeamento.append("Arquivo Retidos: Coluna de 'Equipe' não encontrada.")
-    if not col_forno_r: erros_mapeamento.append("Arquivo Retidos: Coluna de 'Forno' ou 'Linha' não encontrada.")
-
-    # 3. Exibição de Erros e Parada
+    # 2. Exibição de Erros de Mapeamento e Parada
+    erros_mapeamento = erros_p + erros_r
     if erros_mapeamento:
         st.error("⚠️ **Problemas encontrados na estrutura dos arquivos:**")
         for erro in erros_mapeamento:
@@ -224,26 +349,10 @@ if file_prod and file_ret:
         st.info("Dica: Verifique se os nomes das colunas no Excel correspondem ao esperado (ex: 'Equipe', 'M2', 'Forno').")
         st.stop()
 
-    # --- PROCESSAMENTO DOS DADOS (Só roda se passou na validação acima) ---
-    
-    # Tratamento Produção
-    df_prod['metragem_real'] = df_prod[col_metragem].apply(limpar_numero)
-    df_prod['Linha'] = df_prod[col_forno_p].apply(mapear_linha)
-    if col_data_p:
-        df_prod['data_obj'] = pd.to_datetime(df_prod[col_data_p], dayfirst=True, errors='coerce')
-        df_prod['mes_ano'] = df_prod['data_obj'].dt.strftime('%Y-%m')
-    else: df_prod['mes_ano'] = 'Sem Data'
-
-    # Tratamento Retidos
-    df_ret['m2_real'] = df_ret[col_m2].apply(limpar_numero)
-    df_ret['Linha'] = df_ret[col_forno_r].apply(mapear_linha)
-    if col_data_r:
-        df_ret['data_obj'] = pd.to_datetime(df_ret[col_data_r], dayfirst=True, errors='coerce')
-        df_ret['mes_ano'] = df_ret['data_obj'].dt.strftime('%Y-%m')
-    else: df_ret['mes_ano'] = 'Sem Data'
-
     # --- SIDEBAR: ANÁLISE ESPECÍFICA ---
-    todos_motivos_brutos = sorted(df_ret[col_motivo].astype(str).unique())
+    # Motivo é categórico: as categorias já são os valores únicos, sem varrer a coluna
+    categorias_motivo = df_ret['Motivo'].cat.categories
+    todos_motivos_brutos = sorted(categorias_motivo.astype(str))
     motivo_alvo = st.sidebar.selectbox("🔎 Escolha o Motivo:", ["(Selecione um motivo)"] + todos_motivos_brutos)
     st.sidebar.markdown("**Metas para este Motivo:**")
     c_sb1, c_sb2 = st.sidebar.columns(2)
@@ -258,11 +367,11 @@ if file_prod and file_ret:
     st.sidebar.write("**Filtros Gerais**")
     motivos_excluir = st.sidebar.multiselect("🗑️ Excluir Motivos", options=todos_motivos_brutos)
     
-    df_ret_filtrado = df_ret[~df_ret[col_motivo].isin(motivos_excluir)].copy() if motivos_excluir else df_ret.copy()
+    df_ret_filtrado = df_ret[~df_ret['Motivo'].isin(motivos_excluir)] if motivos_excluir else df_ret
 
     if 'grupos_dict' not in st.session_state: st.session_state.grupos_dict = {}
     with st.sidebar.expander("➕ Criar Agrupamento"):
-        motivos_disp = sorted(df_ret_filtrado[col_motivo].unique())
+        motivos_disp = [m for m in categorias_motivo if m not in motivos_excluir]
         selecao = st.multiselect("Selecione:", motivos_disp)
         nome = st.text_input("Nome do Grupo")
         if st.button("Salvar Grupo") and selecao and nome:
@@ -276,34 +385,33 @@ if file_prod and file_ret:
         for r in remover: del st.session_state.grupos_dict[r]
         if remover: st.rerun()
 
-    def definir_motivo(m):
-        for g, l in st.session_state.grupos_dict.items():
-            if m in l: return g
-        return m
-    df_ret_filtrado['Motivo_Analise'] = df_ret_filtrado[col_motivo].apply(definir_motivo)
+    # Mapa inverso motivo -> grupo (o primeiro grupo que contém o motivo prevalece)
+    grupo_do_motivo = {}
+    for g, l in st.session_state.grupos_dict.items():
+        for m in l: grupo_do_motivo.setdefault(m, g)
+    mapa_motivos = {m: grupo_do_motivo.get(m, m) for m in categorias_motivo}
+    df_ret_filtrado = df_ret_filtrado.assign(Motivo_Analise=df_ret_filtrado['Motivo'].map(mapa_motivos))
 
     # --- CÁLCULOS KPI GERAL ---
-    df_p_agg = df_prod.rename(columns={col_equipe_p: 'Equipe'})
-    df_r_agg = df_ret_filtrado.rename(columns={col_equipe_r: 'Equipe'})
-
-    prod_agg = df_p_agg.groupby(['Linha', 'Equipe'])['metragem_real'].sum().reset_index().rename(columns={'metragem_real': 'M2_Produzido'})
-    ret_agg = df_r_agg.groupby(['Linha', 'Equipe'])['m2_real'].sum().reset_index().rename(columns={'m2_real': 'M2_Retido'})
-    df_final = pd.merge(prod_agg, ret_agg, on=['Linha', 'Equipe'], how='left').fillna(0)
+    prod_agg = df_prod.groupby(['Linha', 'Equipe'], observed=True, sort=False)['metragem_real'].sum().reset_index().rename(columns={'metragem_real': 'M2_Produzido'})
+    ret_agg = df_ret_filtrado.groupby(['Linha', 'Equipe'], observed=True, sort=False)['m2_real'].sum().reset_index().rename(columns={'m2_real': 'M2_Retido'})
+    # Mesmas categorias dos dois lados para o merge usar os códigos inteiros
+    equipes = prod_agg['Equipe'].cat.categories.union(ret_agg['Equipe'].cat.categories)
+    prod_agg['Equipe'] = prod_agg['Equipe'].cat.set_categories(equipes)
+    ret_agg['Equipe'] = ret_agg['Equipe'].cat.set_categories(equipes)
+    df_final = pd.merge(prod_agg, ret_agg, on=['Linha', 'Equipe'], how='left').fillna({'M2_Retido': 0})
     
-    df_final['Meta_M2'] = df_final['M2_Produzido'] * (META_PCT / 100)
-    df_final['Saldo_M2'] = df_final['Meta_M2'] - df_final['M2_Retido']
-    df_final['% Realizado'] = (df_final['M2_Retido'] / df_final['M2_Produzido']) * 100
+    df_final = df_final.assign(**calcular_kpis(df_final['M2_Produzido'].to_numpy(), df_final['M2_Retido'].to_numpy(), META_PCT))
 
     df_l45_completo = adicionar_linha_geral(df_final, 'Linha 4 e 5', META_PCT)
     df_l6_completo = adicionar_linha_geral(df_final, 'Linha 6', META_PCT)
 
-    def definir_status_meta(valor_pct): return 'Dentro da Meta (Verde)' if valor_pct <= META_PCT else 'Fora da Meta (Vermelho)'
-    if df_l45_completo is not None: df_l45_completo['Status'] = df_l45_completo['% Realizado'].apply(definir_status_meta)
-    if df_l6_completo is not None: df_l6_completo['Status'] = df_l6_completo['% Realizado'].apply(definir_status_meta)
+    def definir_status_meta(pct): return np.where(pct.to_numpy() <= META_PCT, 'Dentro da Meta (Verde)', 'Fora da Meta (Vermelho)')
+    if df_l45_completo is not None: df_l45_completo['Status'] = definir_status_meta(df_l45_completo['% Realizado'])
+    if df_l6_completo is not None: df_l6_completo['Status'] = definir_status_meta(df_l6_completo['% Realizado'])
 
     df_tabela_final = pd.concat([df_l45_completo, df_l6_completo], ignore_index=True)
-    cols_exist = [c for c in df_tabela_final.columns if c in ['Linha', 'Equipe', 'M2_Produzido', 'Meta_M2', 'M2_Retido', 'Saldo_M2', '% Realizado']]
-    df_exibicao = df_tabela_final[cols_exist].copy() if not df_tabela_final.empty else pd.DataFrame()
+    df_exibicao = df_tabela_final[EXIBICAO_COLS]  # Só leitura daqui em diante: sem .copy()
 
     # --- DASHBOARD ---
     tab1, tab2, tab3 = st.tabs(["📊 Resultados Consolidados", "🔍 Análise por Motivo", "💾 Dados Brutos"])
@@ -353,7 +461,7 @@ if file_prod and file_ret:
             if df_l45_completo is not None and not df_l45_completo.empty:
                 fig1 = go.Figure(go.Bar(x=df_l45_completo['Equipe'], y=df_l45_completo['% Realizado'],
                                         marker_color=[mapa_cores.get(s, '#333') for s in df_l45_completo['Status']],
-                                        text=[f"{v:.2f}" for v in df_l45_completo['% Realizado']], textposition='inside'))
+                                        text=formatar_valores(df_l45_completo['% Realizado'], '.2f'), textposition='inside'))
                 fig1.add_hline(y=META_PCT, line_dash="dot")
                 fig1.update_layout(title="L4/L5: % ", template=TEMPLATE_GRAFICO)
                 st.plotly_chart(fig1, use_container_width=True)
@@ -362,20 +470,23 @@ if file_prod and file_ret:
             if df_l6_completo is not None and not df_l6_completo.empty:
                 fig2 = go.Figure(go.Bar(x=df_l6_completo['Equipe'], y=df_l6_completo['% Realizado'],
                                         marker_color=[mapa_cores.get(s, '#333') for s in df_l6_completo['Status']],
-                                        text=[f"{v:.2f}" for v in df_l6_completo['% Realizado']], textposition='inside'))
+                                        text=formatar_valores(df_l6_completo['% Realizado'], '.2f'), textposition='inside'))
                 fig2.add_hline(y=META_PCT, line_dash="dot")
                 fig2.update_layout(title="L6: % ", template=TEMPLATE_GRAFICO)
                 st.plotly_chart(fig2, use_container_width=True)
 
         st.markdown("---")
         st.subheader("📅 Evolução Mensal")
-        if 'mes_ano' in df_p_agg.columns:
+        if 'mes_ano' in df_prod.columns:
+            # Só as colunas que o gráfico usa: o hash do cache fica proporcional a elas, não ao arquivo inteiro
+            df_p_evol = df_prod[['Linha', 'mes_ano', 'Equipe', 'metragem_real']]
+            df_r_evol = df_ret_filtrado[['Linha', 'mes_ano', 'Equipe', 'm2_real']]
             col_t1, col_t2 = st.columns(2)
             with col_t1:
-                fig_t1 = criar_grafico_evolucao_com_geral(df_prod.rename(columns={col_equipe_p: 'Equipe'}), df_ret_filtrado.rename(columns={col_equipe_r: 'Equipe'}), 'Linha 4 e 5', META_PCT)
+                fig_t1 = criar_grafico_evolucao_com_geral(df_p_evol, df_r_evol, 'Linha 4 e 5', META_PCT)
                 if fig_t1: st.plotly_chart(fig_t1, use_container_width=True)
             with col_t2:
-                fig_t2 = criar_grafico_evolucao_com_geral(df_prod.rename(columns={col_equipe_p: 'Equipe'}), df_ret_filtrado.rename(columns={col_equipe_r: 'Equipe'}), 'Linha 6', META_PCT)
+                fig_t2 = criar_grafico_evolucao_com_geral(df_p_evol, df_r_evol, 'Linha 6', META_PCT)
                 if fig_t2: st.plotly_chart(fig_t2, use_container_width=True)
         
         st.markdown("---")
@@ -386,42 +497,42 @@ if file_prod and file_ret:
         st.subheader("🏆 Top Causas de Retenção")
         c1, c2 = st.columns(2)
         
+        # Uma única agregação por (Linha, Motivo) atende às duas linhas
+        top_all = df_ret_filtrado.groupby(['Linha', 'Motivo_Analise'], observed=True, sort=False)['m2_real'].sum()
+        linhas_com_dados = set(top_all.index.get_level_values('Linha'))
         for i, linha in enumerate(['Linha 4 e 5', 'Linha 6']):
-            df_m = df_ret_filtrado[df_ret_filtrado['Linha'] == linha]
-            if not df_m.empty:
-                top = df_m.groupby('Motivo_Analise')['m2_real'].sum().sort_values(ascending=False).head(10).reset_index()
-                fig_top = px.bar(top, y='Motivo_Analise', x='m2_real', orientation='h', title=f"Top 10 - {linha}", text_auto='.2f', template=TEMPLATE_GRAFICO)
-                fig_top.update_layout(xaxis=dict(range=[0, top['m2_real'].max()*1.25]))
+            if linha in linhas_com_dados:
+                top = top_all.loc[linha].nlargest(10).reset_index()
+                fig_top = criar_grafico_top(top, linha)
                 if i==0: c1.plotly_chart(fig_top, use_container_width=True)
                 else: c2.plotly_chart(fig_top, use_container_width=True)
 
     with tab2:
         if motivo_alvo and motivo_alvo != "(Selecione um motivo)":
             st.subheader(f"🔎 Análise: {motivo_alvo}")
-            df_spec = df_ret[df_ret[col_motivo] == motivo_alvo].copy()
-            todas_equipes = pd.DataFrame({'Equipe': sorted(df_prod[col_equipe_p].unique())})
+            df_spec = df_ret[df_ret['Motivo'] == motivo_alvo].copy()
+            todas_equipes = pd.DataFrame({'Equipe': sorted(df_prod['Equipe'].unique())})
             
-            spec_agg = df_spec.groupby(col_equipe_r)['m2_real'].sum().reset_index().rename(columns={col_equipe_r: 'Equipe', 'm2_real': 'M2_Retido'})
-            spec_count = df_spec.groupby(col_equipe_r).size().reset_index(name='Qtd_Ocorrencias')
+            spec_agg = df_spec.groupby('Equipe', observed=True, sort=False)['m2_real'].sum().reset_index().rename(columns={'m2_real': 'M2_Retido'})
+            spec_count = df_spec.groupby('Equipe', observed=True, sort=False).size().reset_index(name='Qtd_Ocorrencias')
             spec_final = pd.merge(todas_equipes, spec_agg, on='Equipe', how='left').fillna(0)
             spec_final = pd.merge(spec_final, spec_count, on='Equipe', how='left').fillna(0)
             
             c1, c2 = st.columns(2)
             with c1:
-                spec_final['Cor_M2'] = spec_final['M2_Retido'].apply(lambda x: '#27AE60' if x <= META_ABSOLUTA_M2 or not USAR_META_M2 else '#E74C3C')
-                fig = go.Figure(go.Bar(x=spec_final['Equipe'], y=spec_final['M2_Retido'], marker_color=spec_final['Cor_M2'], text=[f"{v:.2f}" for v in spec_final['M2_Retido']], textposition='auto'))
+                spec_final['Cor_M2'] = np.where((spec_final['M2_Retido'].to_numpy() <= META_ABSOLUTA_M2) | (not USAR_META_M2), '#27AE60', '#E74C3C')
+                fig = go.Figure(go.Bar(x=spec_final['Equipe'], y=spec_final['M2_Retido'], marker_color=spec_final['Cor_M2'], text=formatar_valores(spec_final['M2_Retido'], '.2f'), textposition='auto'))
                 if USAR_META_M2: fig.add_hline(y=META_ABSOLUTA_M2, line_dash="dash", annotation_text="Meta")
                 fig.update_layout(title="Metragem por Equipe", template=TEMPLATE_GRAFICO)
                 st.plotly_chart(fig, use_container_width=True)
             with c2:
-                spec_final['Cor_Qtd'] = spec_final['Qtd_Ocorrencias'].apply(lambda x: '#27AE60' if x <= META_FREQ_QTD or not USAR_META_FREQ else '#E74C3C')
+                spec_final['Cor_Qtd'] = np.where((spec_final['Qtd_Ocorrencias'].to_numpy() <= META_FREQ_QTD) | (not USAR_META_FREQ), '#27AE60', '#E74C3C')
                 fig = go.Figure(go.Bar(x=spec_final['Equipe'], y=spec_final['Qtd_Ocorrencias'], marker_color=spec_final['Cor_Qtd'], text=spec_final['Qtd_Ocorrencias'], textposition='auto'))
                 if USAR_META_FREQ: fig.add_hline(y=META_FREQ_QTD, line_dash="dash", annotation_text="Meta")
                 fig.update_layout(title="Quantidade de Ocorrências", template=TEMPLATE_GRAFICO)
                 st.plotly_chart(fig, use_container_width=True)
 
-            df_spec['Linha'] = df_spec[col_forno_r].apply(mapear_linha)
-            spec_linha = df_spec.groupby('Linha').size().reset_index(name='Qtd_Ocorrencias')
+            spec_linha = df_spec.groupby('Linha', observed=True).size().reset_index(name='Qtd_Ocorrencias')
             fig_l = px.bar(spec_linha, x='Linha', y='Qtd_Ocorrencias', text='Qtd_Ocorrencias', title="Ocorrências por Linha", template=TEMPLATE_GRAFICO)
             st.plotly_chart(fig_l, use_container_width=True)
         else:
@@ -0,0 +1,16 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from GeradorRelatorio import convert_df_to_excel
+
+
+def test_exporta_inf_e_nan():
+    # Equipe com retido e sem produção gera '% Realizado' = inf
+    df = pd.DataFrame({'Equipe': ['A', 'B'], '% Realizado': [np.inf, 1.5], 'Saldo_M2': [np.nan, 2.0]})
+    lido = pd.read_excel(BytesIO(convert_df_to_excel(df)))
+    assert list(lido.columns) == ['Equipe', '% Realizado', 'Saldo_M2']
+    assert lido.loc[0, '% Realizado'] == 'inf'
+    assert lido.loc[1, '% Realizado'] == 1.5
+    assert pd.isna(lido.loc[0, 'Saldo_M2'])